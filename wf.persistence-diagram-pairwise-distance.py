@@ -2,6 +2,10 @@
 
 import os
 import re
+import math
+import time
+import random
+import multiprocessing
 import argparse
 import mimetypes
 import itertools
@@ -11,6 +15,27 @@ import numpy as np
 from dask_jobqueue import HTCondorCluster
 from dask.distributed import Client, progress
 
+# Upper bound on the number of HTCondor jobs (workers) requested
+MAX_WORKERS = 200
+# Minimum useful lifetime of a worker, in seconds. Condor job startup takes minutes, so a worker should have at
+# least this much work to do to be worth requesting. Also used as the Dask adaptive target duration
+MIN_WORKER_SECONDS = 600
+# Factor applied to the planned number of workers to get the adaptive scaling ceiling, so that Dask can still add
+# workers if the plan underestimates the cost of the run
+WORKER_SAFETY_FACTOR = 4
+# Estimated time for HTCondor to start a worker, in seconds
+WORKER_STARTUP_SECONDS = 120
+# Smallest per-worker memory request, in GB
+MIN_WORKER_MEMORY_GB = 1
+# Safety factor applied to the predicted memory per task
+MEMORY_SAFETY_FACTOR = 1.5
+# Default exponent of the number of diagram points used to model the cost of a distance calculation, used when the
+# exponent cannot be fitted to the timed samples
+COST_EXPONENTS = {"bottleneck": 1.5, "wasserstein": 3.0}
+# Bounds on the fitted cost exponent, to keep noisy timings of small diagrams from producing an unusable model
+MIN_COST_EXPONENT = 1.0
+MAX_COST_EXPONENT = 4.0
+
 
 def options():
     """Parse command line options.
@@ -23,10 +48,18 @@ def options():
 
     parser = argparse.ArgumentParser(description="Calculates pairwise distances between persistence diagrams.")
     parser.add_argument("-d", "--dir", help="Directory containing persistance diagrams.", required=True)
-    parser.add_argument("-o", "--outfile", help="The output matrix filename.", required=True)
+    parser.add_argument("-o", "--outfile", help="The output matrix filename (not required with --plan).")
     parser.add_argument("-m", "--method", help="Distance method (bottlebeck or wasserstein", default="bottleneck")
     parser.add_argument("-q", "--wasserstein_q", help="Wasserstein q parameter (ignored by bottleneck distance)",
                         default=2, type=int)
+    parser.add_argument("-p", "--plan", help="Dry run: estimate the cost of the run and exit without starting a "
+                                             "cluster.", action="store_true")
+    parser.add_argument("-a", "--adaptive", help="Use Dask adaptive scaling with bounds derived from a cost plan.",
+                        action="store_true")
+    parser.add_argument("-s", "--samples", help="Number of diagram pairs timed locally to build the cost plan "
+                                                "(default 10, only used with --plan or --adaptive).", type=int)
+    parser.add_argument("-w", "--max_workers", help="Maximum number of workers (overrides the default of 200, or the "
+                                                    "ceiling derived from the cost plan with --adaptive).", type=int)
     args = parser.parse_args()
 
     # Valid distance metrics
@@ -34,6 +67,25 @@ def options():
     if args.method.lower() not in valid_methods:
         raise RuntimeError(f"The method {args.method} is not valid. Only bottleneck and wasserstein are supported.")
 
+    # The output matrix is only written when the distances are calculated
+    if args.outfile is None and not args.plan:
+        raise RuntimeError("An output matrix filename (-o/--outfile) is required unless --plan is used.")
+
+    # Pairs are only timed when a cost plan is made
+    if args.samples is not None and not (args.plan or args.adaptive):
+        raise RuntimeError("The number of samples (-s/--samples) can only be used with --plan or --adaptive.")
+    if args.samples is None:
+        args.samples = 10
+
+    # At least one pair has to be timed to estimate the cost of the run
+    if args.samples < 1:
+        raise RuntimeError(f"The number of samples {args.samples} is not valid. At least 1 sample is required.")
+
+    # The cluster needs at least one worker
+    if args.max_workers is not None and args.max_workers < 1:
+        raise RuntimeError(f"The maximum number of workers {args.max_workers} is not valid. At least 1 worker is "
+                           f"required.")
+
     return args
 
 
@@ -78,19 +130,15 @@ def distance(diagram1, diagram2, method, q):
     return diagram1["id"], diagram2["id"], dist
 
 
-def main():
-    # Parse flags
-    args = options()
+def find_diagrams(directory):
+    """Find the persistence diagram files (all text files) in a directory.
 
-    # Configure HTCondor cluster
-    cluster = HTCondorCluster(
-        cores=1,
-        memory="1GB",
-        disk="1GB",
-        local_directory="$_CONDOR_SCRATCH_DIR",
-        job_name="dionysus"
-    )
+    Args:
+        directory: Directory containing persistence diagrams.
 
+    Returns:
+        list of dictionaries of the ID and path of each diagram.
+    """
     # Collect diagram filenames
     diagrams = []
 
@@ -98,12 +146,10 @@ def main():
     pat = re.compile("diagram0*")
 
     # Walk through the input directory and find the diagram files (all text files)
-    diagram_n = 0
-    for (dirpath, dirnames, filenames) in os.walk(args.dir):
+    for (dirpath, dirnames, filenames) in os.walk(directory):
         for filename in filenames:
             # Is the file a text file?
             if 'text/plain' in mimetypes.guess_type(filename):
-                diagram_n += 1
                 # Extract diagram ID
                 dgm_id = os.path.splitext(filename)[0]
                 dgm_id = re.sub(pat, "", dgm_id)
@@ -115,16 +161,252 @@ def main():
                 }
                 # Append the diagram to the list of diagrams
                 diagrams.append(diagram)
+    return diagrams
+
+
+def diagram_size(file):
+    """Count the number of birth/death pairs in a diagram file.
+
+    Args:
+        file: Path to a persistence diagram file.
+
+    Returns:
+        int number of birth/death pairs.
+    """
+    with open(file, "r") as fh:
+        return sum(1 for line in fh if line.strip())
+
+
+def pair_cost(size1, size2, exponent):
+    """Relative cost of a distance calculation between two diagrams.
+
+    Args:
+        size1: Number of points in the first diagram.
+        size2: Number of points in the second diagram.
+        exponent: Exponent of the number of points in the cost model.
+
+    Returns:
+        float cost in arbitrary units.
+    """
+    return (size1 + size2) ** exponent
+
+
+def fit_cost_exponent(points, seconds, method):
+    """Fit the cost model exponent to timed distance calculations.
+
+    Args:
+        points: List of the number of points in each timed pair.
+        seconds: List of the run time in seconds of each timed pair.
+        method: "bottleneck" or "wasserstein" distance metric.
+
+    Returns:
+        float exponent of the number of points.
+    """
+    # A log-log fit needs at least two distinct pair sizes and positive values
+    if len(set(points)) < 2 or min(points) <= 0 or min(seconds) <= 0:
+        return COST_EXPONENTS[method.lower()]
+    exponent = np.polyfit(np.log(points), np.log(seconds), 1)[0]
+    return float(np.clip(exponent, MIN_COST_EXPONENT, MAX_COST_EXPONENT))
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process to its current resident memory (Linux only)."""
+    # Writing 5 to clear_refs resets the VmHWM high-water mark. The inherited ru_maxrss cannot be reset
+    with open("/proc/self/clear_refs", "w") as fh:
+        fh.write("5")
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process since it started or since the last reset_peak_memory (Linux only).
+
+    Returns:
+        float peak memory in MB.
+    """
+    with open("/proc/self/status", "r") as fh:
+        for line in fh:
+            # VmHWM is reported in KB
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("The peak memory (VmHWM) could not be read from /proc/self/status.")
+
+
+def measure_distance(diagram1, diagram2, method, q):
+    """Time a distance calculation and measure its memory use.
+
+    Meant to be run in a child process. The peak memory is reset before the calculation, so the memory before the
+    calculation is the resident memory of the process (interpreter and imports) and not a peak inherited from its
+    parent.
+
+    Args:
+        diagram1: Dictionary of the ID and path of a diagram.
+        diagram2: Dictionary of the ID and path of a diagram.
+        method: "bottleneck" or "wasserstein" distance metric.
+        q: Wasserstein q parameter (ignored by bottleneck-distance).
+
+    Returns:
+        tuple of the run time in seconds, the resident memory before the calculation in MB and the peak memory after
+        the calculation in MB.
+    """
+    reset_peak_memory()
+    baseline_mb = peak_memory_mb()
+    start = time.perf_counter()
+    distance(diagram1=diagram1, diagram2=diagram2, method=method, q=q)
+    seconds = time.perf_counter() - start
+    return seconds, baseline_mb, peak_memory_mb()
+
+
+def plan(diagrams, method, q, samples, max_workers=None):
+    """Estimate the cost of calculating all pairwise distances.
+
+    Diagram sizes are scanned, a random sample of pairs is timed locally, and the timings are extrapolated to all
+    pairs with a cost model based on the number of diagram points. The exponent of the cost model is fitted to the
+    timings with a log-log fit. Each sampled pair runs in its own child process so that its memory use can be
+    measured, and memory is fitted linearly against the number of points in the pair.
+
+    Args:
+        diagrams: List of dictionaries of the ID and path of each diagram.
+        method: "bottleneck" or "wasserstein" distance metric.
+        q: Wasserstein q parameter (ignored by bottleneck-distance).
+        samples: Number of diagram pairs to time.
+        max_workers: Maximum number of workers for adaptive scaling. Derived from the plan if None.
+
+    Returns:
+        dictionary of the predicted costs and cluster settings.
+    """
+    # Scan the number of points in each diagram
+    sizes = np.array([diagram_size(diagram["path"]) for diagram in diagrams], dtype=float)
+    total_pairs = scipy.special.comb(len(diagrams), 2, exact=True, repetition=False)
+
+    # Time a random sample of pairs
+    rng = random.Random(0)
+    sample = set()
+    while len(sample) < min(samples, total_pairs):
+        sample.add(tuple(sorted(rng.sample(range(len(diagrams)), 2))))
+    sample_seconds = []
+    sample_points = []
+    sample_task_mb = []
+    baseline_mb = 0.0
+    # A new process (not a fork of this one) is started for every pair, so each measurement starts from the memory of
+    # a fresh interpreter with the script's imports, the same as a Dask worker
+    with multiprocessing.get_context("spawn").Pool(processes=1, maxtasksperchild=1) as pool:
+        for i, j in sample:
+            inputs = {"diagram1": diagrams[i], "diagram2": diagrams[j], "method": method, "q": q}
+            seconds, start_mb, end_mb = pool.apply(measure_distance, kwds=inputs)
+            sample_seconds.append(seconds)
+            sample_points.append(sizes[i] + sizes[j])
+            sample_task_mb.append(end_mb - start_mb)
+            baseline_mb = max(baseline_mb, start_mb)
+
+    # Without any timed pairs the cost of the run cannot be estimated
+    if sum(sample_points) == 0:
+        raise RuntimeError("At least two non-empty diagrams are required to estimate the cost of the run.")
+
+    # Total cost units of the timed pairs and of all pairs
+    exponent = fit_cost_exponent(points=sample_points, seconds=sample_seconds, method=method)
+    sample_cost = np.sum(np.asarray(sample_points) ** exponent)
+    total_cost = 0.0
+    for i in range(len(sizes) - 1):
+        total_cost += np.sum(pair_cost(sizes[i], sizes[i + 1:], exponent))
+
+    # Extrapolate the sample timings to all pairs
+    seconds_per_cost = sum(sample_seconds) / sample_cost
+    cpu_seconds = total_cost * seconds_per_cost
+
+    # Memory is assumed to scale linearly with the number of points in a pair, extrapolated to the largest pair
+    largest_points = np.sum(np.sort(sizes)[-2:])
+    if len(set(sample_points)) > 1:
+        slope, intercept = np.polyfit(sample_points, sample_task_mb, 1)
+        task_mb = max(0.0, intercept + slope * largest_points, max(sample_task_mb))
+    else:
+        task_mb = max(sample_task_mb) * largest_points / sample_points[0]
+    memory_gb = max(MIN_WORKER_MEMORY_GB, math.ceil((baseline_mb + task_mb) * MEMORY_SAFETY_FACTOR / 1024))
+
+    # Only plan for as many workers as there is work to keep busy. The predicted wall time assumes this many workers
+    planned_workers = max(1, min(MAX_WORKERS, total_pairs, math.ceil(cpu_seconds / MIN_WORKER_SECONDS)))
+    wall_seconds = WORKER_STARTUP_SECONDS + cpu_seconds / planned_workers
+
+    # Leave room above the plan for adaptive scaling, in case the cost of the run is underestimated
+    if max_workers is None:
+        max_workers = min(MAX_WORKERS, total_pairs, planned_workers * WORKER_SAFETY_FACTOR)
+
+    return {
+        "diagrams": len(diagrams),
+        "total_pairs": total_pairs,
+        "sampled_pairs": len(sample),
+        "cost_exponent": exponent,
+        "min_points": int(sizes.min()) if len(sizes) else 0,
+        "max_points": int(sizes.max()) if len(sizes) else 0,
+        "cpu_hours": cpu_seconds / 3600,
+        "wall_hours": wall_seconds / 3600,
+        "task_memory_mb": baseline_mb + task_mb,
+        "worker_memory_gb": memory_gb,
+        "planned_workers": planned_workers,
+        "min_workers": 1,
+        "max_workers": max_workers
+    }
+
+
+def print_plan(cost):
+    """Print a cost plan.
+
+    Args:
+        cost: Dictionary returned by plan.
+    """
+    print(f"Diagrams:               {cost['diagrams']} ({cost['min_points']}-{cost['max_points']} points)")
+    print(f"Pairwise distances:     {cost['total_pairs']} ({cost['sampled_pairs']} timed)")
+    print(f"Cost model:             (points in pair)^{cost['cost_exponent']:.2f}")
+    print(f"Predicted CPU time:     {cost['cpu_hours']:.2f} hours")
+    print(f"Planned workers:        {cost['planned_workers']}")
+    print(f"Predicted wall time:    {cost['wall_hours']:.2f} hours (with the planned workers)")
+    print(f"Predicted task memory:  {cost['task_memory_mb']:.0f} MB")
+    print(f"Worker memory request:  {cost['worker_memory_gb']}GB")
+    print(f"Adaptive workers:       {cost['min_workers']}-{cost['max_workers']}")
+
+
+def main():
+    # Parse flags
+    args = options()
+
+    # Find the diagram files
+    diagrams = find_diagrams(directory=args.dir)
+    diagram_n = len(diagrams)
 
     # Get all pairwise combinations of diagrams
     pairs = itertools.combinations(diagrams, 2)
     total_pairs = scipy.special.comb(diagram_n, 2, exact=True, repetition=False)
 
-    # Configure number of workers
-    max_workers = 200
-    if total_pairs < max_workers:
-        max_workers = total_pairs
-    cluster.scale(jobs=max_workers)
+    # Estimate the cost of the run
+    cost = None
+    if args.plan or args.adaptive:
+        cost = plan(diagrams=diagrams, method=args.method, q=args.wasserstein_q, samples=args.samples,
+                    max_workers=args.max_workers)
+        print_plan(cost)
+        if args.plan:
+            return
+
+    # Configure HTCondor cluster
+    memory = f"{cost['worker_memory_gb']}GB" if cost else "1GB"
+    cluster = HTCondorCluster(
+        cores=1,
+        memory=memory,
+        disk="1GB",
+        local_directory="$_CONDOR_SCRATCH_DIR",
+        job_name="dionysus"
+    )
+
+    if args.adaptive:
+        # Scale with the remaining work: workers are requested to finish the queued tasks in about
+        # MIN_WORKER_SECONDS and are released as the queue drains
+        cluster.adapt(minimum_jobs=cost["min_workers"], maximum_jobs=cost["max_workers"],
+                      target_duration=f"{MIN_WORKER_SECONDS}s", interval="10s")
+    else:
+        # Configure number of workers
+        max_workers = MAX_WORKERS
+        if args.max_workers is not None:
+            max_workers = args.max_workers
+        if total_pairs < max_workers:
+            max_workers = total_pairs
+        cluster.scale(jobs=max_workers)
     client = Client(cluster)
 
     # List of job futures